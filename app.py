@@ -1,13 +1,28 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+from flask import Flask, Response, render_template, request, jsonify, session, redirect, url_for
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from flask_compress import Compress
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import FileTarget, ValueTarget
 import os
+import re
+import sqlite3
+import json
+import hmac
+import time
+import hashlib
+import threading
+import orjson
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import secrets
 from datetime import datetime, timedelta
 
 load_dotenv()  # Load environment variables from .env file
-from utils.ai_matcher import AIMatchmaker
+from utils.ai_matcher import AIMatchmaker, top_k_indices
 from utils.replit_analyzer import ReplAnalyzer
 from utils.database import Database
 
@@ -19,7 +34,20 @@ app.config['SESSION_COOKIE_SECURE'] = True  # Only send cookie over HTTPS
 app.config['SESSION_COOKIE_HTTPONLY'] = True  # Prevent JavaScript access to session cookie
 app.config['UPLOAD_FOLDER'] = 'static/uploads/profile_photos'
 app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024  # 5MB max file size
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']  # Match/search JSON repeats keys per user
+app.config['COMPRESS_MIN_SIZE'] = 500
+Compress(app)
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+_allowed_file_search = re.compile(
+    r'\.(?:%s)\Z' % '|'.join(sorted(ALLOWED_EXTENSIONS)), re.IGNORECASE
+).search
+UPLOAD_CHUNK_SIZE = 64 * 1024
+SEARCH_RESULTS_LIMIT = 50
+PASSWORD_CACHE_TTL = 300  # seconds a successful password check is reused
+PASSWORD_CACHE_SIZE = 4096
+PROFILE_LIST_MAX_ITEMS = 50  # entries per skills/interests/tech_stack/project_types list
+PROFILE_ITEM_MAX_LENGTH = 64  # characters per list entry and Replit username
+PROFILE_BIO_MAX_LENGTH = 1000
 
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -27,11 +55,141 @@ os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 # Initialize utilities
 db = Database()
 matcher = AIMatchmaker()
-analyzer = ReplAnalyzer()
+analyzer = ReplAnalyzer(store=db)
+
+# Network-bound profile work (Repl analysis, bio embedding) runs off the request thread
+_bg = ThreadPoolExecutor(max_workers=4)
+_repl_jobs = {}  # user_id -> Future of the latest Repl analysis
+
+# Jobs from an older save may finish after a newer one's; each job carries the token of
+# the save that queued it and only writes while that save is still the user's latest.
+# Locks are per user so one user's save never waits on another's.
+_latest_saves = {}  # user_id -> token of the most recent profile save
+_save_locks = {}  # user_id -> lock held while saving or checking that user's token
+_save_locks_lock = threading.Lock()
+
+def _save_lock(user_id):
+    """Return the lock serializing a user's profile save with its background writes"""
+    with _save_locks_lock:
+        return _save_locks.setdefault(user_id, threading.Lock())
+
+def _analyze_and_store(user_id, replit_username, save_token):
+    """Analyze a user's Repls and persist the result"""
+    try:
+        repl_data = analyzer.analyze_user_repls(replit_username)
+        with _save_lock(user_id):
+            if _latest_saves.get(user_id) is save_token:
+                db.update_repl_data(user_id, repl_data)
+    except Exception as e:
+        print(f"Error analyzing Repls: {str(e)}")
+
+def _embed_and_store(user_id, bio, save_token):
+    """Embed a bio and persist it; clears the embedding if it is unavailable"""
+    try:
+        embedding = matcher.embed_bio(bio)
+        if embedding is None:
+            features = {'bio_emb': None, 'bio_scale': None}
+        else:
+            # Quantize once at write time so matching only ever reads int8
+            quantized, scale = db.quantize_embedding(embedding)
+            features = {'bio_emb': quantized.tobytes(), 'bio_scale': scale}
+        
+        with _save_lock(user_id):
+            if _latest_saves.get(user_id) is save_token:
+                db.save_feature_vectors(user_id, features)
+    except Exception as e:
+        print(f"Error embedding bio: {str(e)}")
+
+# Successful password checks keyed on (hash, keyed digest of the plaintext)
+_password_key = secrets.token_bytes(32)
+_verified_passwords = OrderedDict()
+_verified_passwords_lock = threading.Lock()
+
+def verify_password(password_hash, password):
+    """check_password_hash that skips re-hashing recently verified credentials"""
+    key = (password_hash, hmac.new(_password_key, password.encode(), hashlib.sha256).digest())
+    with _verified_passwords_lock:
+        expires_at = _verified_passwords.get(key)
+        if expires_at and expires_at > time.time():
+            return True
+    
+    if not check_password_hash(password_hash, password):
+        return False
+    
+    with _verified_passwords_lock:
+        _verified_passwords[key] = time.time() + PASSWORD_CACHE_TTL
+        _verified_passwords.move_to_end(key)
+        while len(_verified_passwords) > PASSWORD_CACHE_SIZE:
+            _verified_passwords.popitem(last=False)
+    return True
+
+def ojsonify(obj, status=200):
+    """jsonify via orjson, for the large list responses on the matching endpoints"""
+    return Response(orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY), status=status, mimetype='application/json')
+
+def clean_list(values):
+    """Check a submitted list of names, then strip each entry once and drop the empty ones"""
+    if not isinstance(values, list) or len(values) > PROFILE_LIST_MAX_ITEMS:
+        raise ValueError(f'expected a list of at most {PROFILE_LIST_MAX_ITEMS} names')
+    if not all(isinstance(value, str) and len(value) <= PROFILE_ITEM_MAX_LENGTH for value in values):
+        raise ValueError(f'list entries must be strings of at most {PROFILE_ITEM_MAX_LENGTH} characters')
+    return [value for value in map(str.strip, values) if value]
+
+def clean_text(value, max_length):
+    """Check a submitted free-text field, which may be omitted"""
+    if not isinstance(value, str) or len(value) > max_length:
+        raise ValueError(f'expected a string of at most {max_length} characters')
+    return value
+
+def clean_profile(profile):
+    """Validate a submitted profile object into the fields stored by update_profile"""
+    if not isinstance(profile, dict):
+        raise ValueError('profile part must be a JSON object')
+    
+    skills = clean_list(profile.get('skills', []))
+    interests = clean_list(profile.get('interests', []))
+    
+    # tech_stack/project_types share the skills/interests lists unless sent separately
+    return {
+        'skills': skills,
+        'interests': interests,
+        'tech_stack': clean_list(profile['tech_stack']) if 'tech_stack' in profile else skills,
+        'project_types': clean_list(profile['project_types']) if 'project_types' in profile else interests,
+        'replit_username': clean_text(profile.get('replit_username', ''), PROFILE_ITEM_MAX_LENGTH),
+        'bio': clean_text(profile.get('bio', ''), PROFILE_BIO_MAX_LENGTH)
+    }
 
 def allowed_file(filename):
     """Check if file extension is allowed"""
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    return _allowed_file_search(filename) is not None
+
+def parse_profile_form(user_id):
+    """Stream a multipart profile submission (JSON 'profile' part plus optional photo) in one pass"""
+    temp_path = os.path.join(app.config['UPLOAD_FOLDER'], f".{user_id}_{secrets.token_hex(8)}.part")
+    photo = FileTarget(temp_path)
+    profile = ValueTarget()
+    
+    parser = StreamingFormDataParser(headers=request.headers)
+    parser.register('profile_photo', photo)
+    parser.register('profile', profile)
+    
+    try:
+        while chunk := request.stream.read(UPLOAD_CHUNK_SIZE):
+            parser.data_received(chunk)
+        
+        # Validate before keeping the upload so a rejected submission leaves no file behind
+        profile_data = clean_profile(json.loads(profile.value))
+        
+        # Keep the upload only if a permitted file was actually sent; a missing photo keeps the stored one
+        profile_data['profile_photo'] = None
+        if photo.multipart_filename and allowed_file(photo.multipart_filename):
+            filename = secure_filename(f"{user_id}_{secrets.token_hex(8)}_{photo.multipart_filename}")
+            os.replace(temp_path, os.path.join(app.config['UPLOAD_FOLDER'], filename))
+            profile_data['profile_photo'] = f"uploads/profile_photos/{filename}"
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return profile_data
 
 @app.route('/')
 def index():
@@ -80,7 +238,7 @@ def login():
         if not user:
             return jsonify({'error': 'User not found'}), 401
         
-        if not check_password_hash(user['password'], password):
+        if not verify_password(user['password'], password):
             return jsonify({'error': 'Invalid password'}), 401
         
         session.permanent = True  # Use permanent session
@@ -101,63 +259,54 @@ def profile():
     if request.method == 'POST':
         user_id = session['user_id']
         
-        # Check if it's a file upload or JSON data
-        if request.content_type and 'multipart/form-data' in request.content_type:
-            # Handle form data with file upload
-            profile_photo_path = None
-            if 'profile_photo' in request.files:
-                file = request.files['profile_photo']
-                if file and file.filename and allowed_file(file.filename):
-                    filename = secure_filename(f"{user_id}_{datetime.now().timestamp()}_{file.filename}")
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    file.save(file_path)
-                    profile_photo_path = f"uploads/profile_photos/{filename}"
-            
-            # Parse form data
-            skills = request.form.get('skills', '').split(',') if request.form.get('skills') else []
-            interests = request.form.get('interests', '').split(',') if request.form.get('interests') else []
-            
-            profile_data = {
-                'skills': [s.strip() for s in skills if s.strip()],
-                'interests': [i.strip() for i in interests if i.strip()],
-                'tech_stack': [s.strip() for s in skills if s.strip()],
-                'project_types': [i.strip() for i in interests if i.strip()],
-                'replit_username': request.form.get('replit_username', ''),
-                'bio': request.form.get('bio', ''),
-                'profile_photo': profile_photo_path
-            }
-        else:
-            # Handle JSON data (backward compatibility)
-            data = request.json
-            profile_data = {
-                'skills': data.get('skills', []),
-                'interests': data.get('interests', []),
-                'tech_stack': data.get('tech_stack', []),
-                'project_types': data.get('project_types', []),
-                'replit_username': data.get('replit_username'),
-                'bio': data.get('bio', ''),
-                'profile_photo': data.get('profile_photo')
-            }
+        # Profile JSON and photo arrive together as one multipart body
+        try:
+            profile_data = parse_profile_form(user_id)
+        except (ParseFailedException, ValueError):
+            return jsonify({'error': 'Invalid profile submission'}), 400
         
-        db.update_profile(user_id, profile_data)
+        save_token = object()
+        with _save_lock(user_id):
+            db.update_profile(user_id, profile_data)
+            _latest_saves[user_id] = save_token
+        matcher.invalidate(user_id)
         
-        # Analyze user's Repls
+        # Embed the bio for dense similarity in the background; without Gemini there is nothing to embed
+        if matcher.model:
+            _bg.submit(_embed_and_store, user_id, profile_data['bio'], save_token)
+        
+        # Analyze user's Repls in the background; poll /profile/repl-status for completion
         if profile_data['replit_username']:
-            try:
-                repl_data = analyzer.analyze_user_repls(profile_data['replit_username'])
-                db.update_repl_data(user_id, repl_data)
-            except Exception as e:
-                print(f"Error analyzing Repls: {str(e)}")
+            _repl_jobs[user_id] = _bg.submit(
+                _analyze_and_store, user_id, profile_data['replit_username'], save_token
+            )
+            return jsonify({'success': True, 'redirect': '/dashboard'}), 202
         
-        if request.content_type and 'multipart/form-data' in request.content_type:
-            return redirect(url_for('dashboard'))
-        else:
-            return jsonify({'success': True, 'redirect': '/dashboard'})
+        return jsonify({'success': True, 'redirect': '/dashboard'})
     
     user_id = session['user_id']
     user_data = db.get_user_profile(user_id)
     return render_template('profile.html', user=user_data)
 
+@app.route('/profile/repl-status/<int:user_id>')
+def repl_status(user_id):
+    """Report whether a user's background Repl analysis has finished"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    if user_id != session['user_id']:
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    job = _repl_jobs.get(user_id)
+    if job is not None and not job.done():
+        return jsonify({'status': 'pending'})
+    
+    user_data = db.get_user_profile(user_id)
+    if not user_data:
+        return jsonify({'error': 'User not found'}), 404
+    
+    repl_data = user_data.get('repl_data')
+    return jsonify({'status': 'complete' if repl_data else 'none', 'repl_data': repl_data})
+
 @app.route('/dashboard')
 def dashboard():
     """User dashboard"""
@@ -181,13 +330,13 @@ def find_matches():
     # Get all other users
     all_users = db.get_all_users(exclude_id=user_id)
     
-    # Use AI to find best matches
-    matches = matcher.find_matches(user_profile, all_users)
+    # Use AI to find best matches over the precomputed feature vectors
+    matches = matcher.find_matches(user_profile, all_users, features=db.load_feature_matrix())
     
     # Save matches to database
     db.save_matches(user_id, matches)
     
-    return jsonify({'success': True, 'matches': matches[:10]})
+    return ojsonify({'success': True, 'matches': matches[:10]})
 
 @app.route('/matches')
 def matches():
@@ -216,7 +365,11 @@ def start_collaboration(match_id):
         'repl_url': f'https://replit.com/@shared/collab-{user_id}-{match_id}'
     }
     
-    collab_id = db.create_collaboration(collab_data)
+    try:
+        collab_id = db.create_collaboration(collab_data)
+    except sqlite3.IntegrityError:
+        # Foreign keys reject a match_id that isn't a user
+        return jsonify({'error': 'User not found'}), 404
     
     return jsonify({
         'success': True,
@@ -257,41 +410,51 @@ def search_users():
         return jsonify({'error': 'Not authenticated'}), 401
     
     if request.method == 'POST':
-        data = request.json
-        search_skills = data.get('skills', [])
+        try:
+            data = orjson.loads(request.get_data())
+        except orjson.JSONDecodeError:
+            return jsonify({'error': 'Invalid JSON'}), 400
+        try:
+            search_skills = clean_list(data.get('skills', []) if isinstance(data, dict) else [])
+        except ValueError:
+            return jsonify({'error': 'skills must be a list of names'}), 400
         
         if not search_skills:
             return jsonify({'error': 'No skills provided'}), 400
         
         user_id = session['user_id']
-        all_users = db.get_all_users(exclude_id=user_id)
+        # clean_list already stripped and dropped empty entries
+        search_skills_set = {db.canonical_skill(s) for s in search_skills}
         
-        # Filter users by matching skills
-        matching_users = []
-        for user in all_users:
-            user_skills = set(user.get('skills', []))
-            search_skills_set = set(search_skills)
-            
-            # Calculate match percentage
-            if user_skills:
-                common_skills = user_skills.intersection(search_skills_set)
-                if common_skills:
-                    match_percentage = len(common_skills) / len(search_skills_set) * 100
-                    matching_users.append({
-                        'user_id': user['id'],
-                        'username': user.get('username', 'Unknown'),
-                        'skills': list(user_skills),
-                        'common_skills': list(common_skills),
-                        'interests': user.get('interests', []),
-                        'bio': user.get('bio', ''),
-                        'profile_photo': user.get('profile_photo'),
-                        'match_percentage': round(match_percentage, 1)
-                    })
+        # One sparse matrix-vector product over the user x skill snapshot
+        user_ids, matrix = db.snapshot_profiles()
+        query = np.zeros(matrix.shape[1], dtype=np.int32)
+        query[[i for i in db.find_skill_ids(search_skills_set).values() if i < matrix.shape[1]]] = 1
+        counts = matrix @ query
+        counts[user_ids == user_id] = 0
+        
+        # Rank by match count and hydrate only the winners
+        hits = np.flatnonzero(counts)
+        winners = hits[top_k_indices(counts[hits], SEARCH_RESULTS_LIMIT)]
         
-        # Sort by match percentage
-        matching_users.sort(key=lambda x: x['match_percentage'], reverse=True)
+        common_counts = dict(zip(user_ids[winners].tolist(), counts[winners].tolist()))
+        
+        matching_users = []
+        for user in db.get_users_by_ids(common_counts):
+            match_percentage = common_counts[user['user_id']] / len(search_skills_set) * 100
+            user_skills = user.get('skills', [])
+            matching_users.append({
+                'user_id': user['user_id'],
+                'username': user.get('username', 'Unknown'),
+                'skills': user_skills,
+                'common_skills': [s for s in user_skills if db.canonical_skill(s) in search_skills_set],
+                'interests': user.get('interests', []),
+                'bio': user.get('bio', ''),
+                'profile_photo': user.get('profile_photo'),
+                'match_percentage': round(match_percentage, 1)
+            })
         
-        return jsonify({'success': True, 'users': matching_users})
+        return ojsonify({'success': True, 'users': matching_users})
     
     return render_template('search.html')
 
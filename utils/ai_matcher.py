@@ -1,7 +1,69 @@
 import os
 import json
+import time
+import heapq
+import hashlib
+from operator import itemgetter
+import numpy as np
+from scipy.sparse import csr_matrix, diags
 import google.generativeai as genai
-from typing import List, Dict, Any
+from sklearn.base import clone
+from sklearn.feature_extraction.text import TfidfVectorizer
+from typing import List, Dict, Any, Optional
+
+try:
+    import simsimd
+except ImportError:
+    simsimd = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Profile fields compared by the fallback matcher, in weight order;
+# the last weight applies to bio similarity
+MATCH_CATEGORIES = ('skills', 'interests', 'tech_stack')
+MATCH_WEIGHTS = (0.4, 0.3, 0.2, 0.1)
+
+# Gemini embedding model for bios; vectors are stored int8-quantized
+EMBEDDING_MODEL = 'models/text-embedding-004'
+
+# Candidates sent to Gemini for reranking, pre-filtered by the vectorized scorer
+GEMINI_SHORTLIST_SIZE = 50
+
+# Seconds a Gemini ranking is reused while the profile and pool are unchanged
+GEMINI_CACHE_TTL = 600
+
+# Structured output schema for Gemini rankings
+RANKING_SCHEMA = {
+    'type': 'array',
+    'items': {
+        'type': 'object',
+        'properties': {
+            'index': {'type': 'integer'},
+            'score': {'type': 'integer'},
+            'reason': {'type': 'string'}
+        },
+        'required': ['index', 'score', 'reason']
+    }
+}
+
+def combine_scores(skills, interests, tech, bio, weights):
+    """Weighted sum of the per-candidate score vectors, in MATCH_WEIGHTS order"""
+    return weights[0] * skills + weights[1] * interests + weights[2] * tech + weights[3] * bio
+
+# Fuse the weighted sum into a single compiled loop when numba is available
+if njit is not None:
+    combine_scores = njit(fastmath=True, cache=True)(combine_scores)
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first, without sorting the whole array"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind='stable')]
 
 class AIMatchmaker:
     def __init__(self):
@@ -11,43 +73,153 @@ class AIMatchmaker:
             self.model = None
         else:
             genai.configure(api_key=api_key)
-            self.model = genai.GenerativeModel('gemini-pro')
-    
-    def calculate_jaccard_similarity(self, set1, set2):
-        """Calculate Jaccard similarity between two sets (fallback method)"""
-        if not set1 or not set2:
-            return 0.0
+            self.model = genai.GenerativeModel('gemini-1.5-flash')
+        
+        self._weights = np.array(MATCH_WEIGHTS, dtype=np.float32)
         
-        set1 = set(set1)
-        set2 = set(set2)
-        intersection = len(set1.intersection(set2))
-        union = len(set1.union(set2))
+        # Configured once; each request fits an unfitted clone so concurrent requests don't share state
+        self._tfidf = TfidfVectorizer(norm='l2', dtype=np.float32, sublinear_tf=True, stop_words='english')
         
-        return intersection / union if union > 0 else 0.0
+        # user_id -> (cache key, expires_at, matches) for Gemini rankings
+        self._gemini_cache = {}
     
-    def calculate_match_score_fallback(self, user1, user2):
-        """Fallback matching when Gemini API is not available"""
-        skills_score = self.calculate_jaccard_similarity(
-            user1.get('skills', []),
-            user2.get('skills', [])
-        )
+    def _content_hash(self, data: Any) -> str:
+        """Stable hash of JSON-serializable data"""
+        canonical = json.dumps(data, sort_keys=True, default=str)
+        return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+    
+    def invalidate(self, user_id: int) -> None:
+        """Drop cached Gemini rankings for a user whose profile changed"""
+        self._gemini_cache.pop(user_id, None)
+    
+    def _encode(self, users: List[Dict], category: str) -> csr_matrix:
+        """Encode one category of each user as a row of a sparse (N, V) 0/1 matrix"""
+        # Built per call: columns only need to be consistent within this pool, and a
+        # local dict is neither shared between request threads nor grown forever
+        vocab = {}
+        indptr, indices = [0], []
+        for user in users:
+            # Same canonical form as the interned bitsets stored by Database
+            terms = {term.strip().lower() for term in user.get(category) or []} - {''}
+            indices.extend(vocab.setdefault(term, len(vocab)) for term in terms)
+            indptr.append(len(indices))
         
-        interests_score = self.calculate_jaccard_similarity(
-            user1.get('interests', []),
-            user2.get('interests', [])
+        return csr_matrix(
+            (np.ones(len(indices), dtype=np.float32), indices, indptr),
+            shape=(len(users), len(vocab))
         )
+    
+    def score_candidates(self, user_profile: Dict, all_users: List[Dict],
+                         features: Optional[Dict] = None) -> np.ndarray:
+        """Weighted similarity of the user against every candidate in one pass
         
-        tech_score = self.calculate_jaccard_similarity(
-            user1.get('tech_stack', []),
-            user2.get('tech_stack', [])
-        )
+        With features from Database.load_feature_matrix() the stored bitsets and
+        embeddings are sliced out directly; otherwise profiles are encoded on the fly.
+        """
+        users = [user_profile] + list(all_users)
+        rows = None
+        if features is not None and features['row_index']:
+            # Users without a saved profile get -1 and are zeroed below
+            rows = np.array([features['row_index'].get(user.get('user_id'), -1) for user in users], dtype=np.intp)
+        
+        category_scores = []
+        for category in MATCH_CATEGORIES:
+            if rows is None:
+                matrix = self._encode(users, category)
+            else:
+                present = diags((rows >= 0).astype(np.float32))
+                matrix = (present @ features[category][np.maximum(rows, 0)]).tocsr()
+            user_row, pool = matrix[0], matrix[1:]
+            intersection = (pool @ user_row.T).toarray().ravel()
+            union = user_row.sum() + np.asarray(pool.sum(axis=1)).ravel() - intersection
+            category_scores.append(intersection / np.where(union > 0, union, 1))
+        if rows is not None and features['bio_embedding'] is not None:
+            category_scores.append(self._embedding_similarity(users, rows, features))
+        else:
+            category_scores.append(self._bio_similarity(users))
+        
+        category_scores = [np.asarray(scores, dtype=np.float32) for scores in category_scores]
+        return combine_scores(*category_scores, self._weights)
+    
+    def embed_bio(self, bio: str) -> Optional[np.ndarray]:
+        """Embed a bio with Gemini as a float32 vector, or None when unavailable"""
+        if not self.model or not bio:
+            return None
+        try:
+            result = genai.embed_content(model=EMBEDDING_MODEL, content=bio)
+            return np.asarray(result['embedding'], dtype=np.float32)
+        except Exception as e:
+            print(f"Error embedding bio: {str(e)}")
+            return None
+    
+    def _cosine_similarity(self, user_vec: np.ndarray, pool: np.ndarray) -> np.ndarray:
+        """Cosine similarity of one dense vector against each row of a matrix"""
+        if simsimd is not None:
+            return 1.0 - np.asarray(simsimd.cdist(user_vec[np.newaxis], pool, metric='cosine')).ravel()
+        
+        user_vec, pool = user_vec.astype(np.float32), pool.astype(np.float32)
+        norms = np.linalg.norm(pool, axis=1) * np.linalg.norm(user_vec)
+        return (pool @ user_vec) / np.where(norms > 0, norms, 1)
+    
+    def _embedding_similarity(self, users: List[Dict], rows: np.ndarray, features: Dict) -> np.ndarray:
+        """Cosine similarity of stored bio embeddings, using TF-IDF for candidates without one"""
+        has_embedding = (rows >= 0) & features['has_embedding'][np.maximum(rows, 0)]
+        if not has_embedding[0]:
+            return self._bio_similarity(users)
+        
+        embeddings = features['bio_embedding']
+        scores = np.zeros(len(users) - 1, dtype=np.float32)
+        embedded = np.flatnonzero(has_embedding[1:])
+        if len(embedded):
+            scores[embedded] = self._cosine_similarity(embeddings[rows[0]], embeddings[rows[embedded + 1]])
+        missing = np.flatnonzero(~has_embedding[1:])
+        if len(missing):
+            scores[missing] = self._bio_similarity([users[0]] + [users[idx + 1] for idx in missing])
+        return scores
+    
+    def _bio_similarity(self, users: List[Dict]) -> np.ndarray:
+        """TF-IDF cosine similarity of the first user's bio against the rest"""
+        bios = [user.get('bio') or '' for user in users]
+        try:
+            matrix = clone(self._tfidf).fit_transform(bios)
+        except ValueError:
+            # Empty vocabulary: no candidate has a usable bio
+            return np.zeros(len(users) - 1)
         
-        total_score = (0.4 * skills_score + 0.4 * interests_score + 0.2 * tech_score)
-        return total_score
+        # Rows are already L2-normalized, so the dot product is the cosine
+        return (matrix[1:] @ matrix[0].T).toarray().ravel()
+    
+    def _build_match(self, candidate: Dict, score: float, reason: str) -> Dict:
+        """Shape a candidate into the match dict returned to the client"""
+        return {
+            'user_id': candidate['user_id'],
+            'username': candidate.get('username', 'Unknown'),
+            'score': score,
+            'skills': candidate.get('skills', []),
+            'interests': candidate.get('interests', []),
+            'tech_stack': candidate.get('tech_stack', []),
+            'bio': candidate.get('bio', ''),
+            'match_reason': reason,
+            'profile_photo': candidate.get('profile_photo', None)
+        }
     
-    def find_matches_with_gemini(self, user_profile: Dict, all_users: List[Dict], top_n: int = 10) -> List[Dict]:
+    def find_matches_with_gemini(self, user_profile: Dict, all_users: List[Dict], top_n: int = 10,
+                                 features: Optional[Dict] = None) -> List[Dict]:
         """Use Gemini AI to intelligently match users based on comprehensive analysis"""
+        user_id = user_profile.get('user_id')
+        cache_key = (self._content_hash(user_profile), self._content_hash(all_users), top_n)
+        cached = self._gemini_cache.get(user_id)
+        if cached and cached[0] == cache_key and cached[1] > time.time():
+            return cached[2]
+        
         try:
+            # Rerank only a shortlist so the prompt stays bounded as the pool grows
+            if len(all_users) > GEMINI_SHORTLIST_SIZE:
+                scores = self.score_candidates(user_profile, all_users, features)
+                shortlist = [all_users[idx] for idx in top_k_indices(scores, GEMINI_SHORTLIST_SIZE)]
+            else:
+                shortlist = list(all_users)
+            
             # Prepare user profile summary
             user_summary = f"""
             User Profile:
@@ -58,7 +230,7 @@ class AIMatchmaker:
             
             # Prepare candidates summary
             candidates_summary = []
-            for idx, candidate in enumerate(all_users):
+            for idx, candidate in enumerate(shortlist):
                 candidates_summary.append(f"""
                 Candidate {idx}:
                 - Username: {candidate.get('username', 'Unknown')}
@@ -82,42 +254,33 @@ class AIMatchmaker:
             Candidates:
             {''.join(candidates_summary)}
             
-            Return ONLY a JSON array of candidate indices (0 to {len(all_users)-1}) ranked from best to worst match, with a compatibility score (0-100) and brief reason for each.
-            Format: [[index, score, "reason"], [index, score, "reason"], ...]
-            
-            Example: [[2, 95, "Complementary skills and shared interest in web development"], [0, 78, "Similar skill level, good for peer learning"]]
+            Rank the candidates (indices 0 to {len(shortlist)-1}) from best to worst match, giving each a compatibility score (0-100) and a brief reason.
             """
             
-            response = self.model.generate_content(prompt)
+            response = self.model.generate_content(prompt, generation_config={
+                'response_mime_type': 'application/json',
+                'response_schema': RANKING_SCHEMA
+            })
+            rankings = json.loads(response.text)
             
-            # Parse the response
-            result_text = response.text.strip()
-            # Extract JSON from markdown code blocks if present
-            if '```json' in result_text:
-                result_text = result_text.split('```json')[1].split('```')[0].strip()
-            elif '```' in result_text:
-                result_text = result_text.split('```')[1].split('```')[0].strip()
+            # Structured output doesn't stop Gemini repeating a candidate; keep each one's best entry
+            best = {}
+            for rank_item in rankings:
+                idx = rank_item['index']
+                if 0 <= idx < len(shortlist) and (idx not in best or rank_item['score'] > best[idx]['score']):
+                    best[idx] = rank_item
             
-            rankings = json.loads(result_text)
+            # Build matched results, normalizing scores to 0-1
+            matches = [
+                self._build_match(shortlist[idx], rank_item['score'] / 100.0, rank_item['reason'])
+                for idx, rank_item in best.items()
+            ]
             
-            # Build matched results
-            matches = []
-            for rank_item in rankings[:top_n]:
-                idx, score, reason = rank_item
-                if 0 <= idx < len(all_users):
-                    candidate = all_users[idx]
-                    matches.append({
-                        'user_id': candidate['id'],
-                        'username': candidate.get('username', 'Unknown'),
-                        'score': score / 100.0,  # Normalize to 0-1
-                        'skills': candidate.get('skills', []),
-                        'interests': candidate.get('interests', []),
-                        'tech_stack': candidate.get('tech_stack', []),
-                        'bio': candidate.get('bio', ''),
-                        'match_reason': reason,
-                        'profile_photo': candidate.get('profile_photo', None)
-                    })
+            # Rank by the scores Gemini gave rather than trusting its output order
+            matches = heapq.nlargest(top_n, matches, key=itemgetter('score'))
             
+            if matches:
+                self._gemini_cache[user_id] = (cache_key, time.time() + GEMINI_CACHE_TTL, matches)
             return matches
             
         except Exception as e:
@@ -125,33 +288,24 @@ class AIMatchmaker:
             print("Falling back to traditional matching...")
             return None
     
-    def find_matches(self, user_profile: Dict, all_users: List[Dict], top_n: int = 10) -> List[Dict]:
+    def find_matches(self, user_profile: Dict, all_users: List[Dict], top_n: int = 10,
+                     features: Optional[Dict] = None) -> List[Dict]:
         """Find top N matches for a user using Gemini AI or fallback method"""
+        if not all_users or top_n <= 0:
+            return []
+        
         # Try Gemini AI first
         if self.model:
-            gemini_matches = self.find_matches_with_gemini(user_profile, all_users, top_n)
+            gemini_matches = self.find_matches_with_gemini(user_profile, all_users, top_n, features)
             if gemini_matches:
                 return gemini_matches
         
         # Fallback to traditional matching
         print("Using fallback matching algorithm...")
-        matches = []
-        
-        for other_user in all_users:
-            score = self.calculate_match_score_fallback(user_profile, other_user)
-            matches.append({
-                'user_id': other_user['id'],
-                'username': other_user.get('username', 'Unknown'),
-                'score': score,
-                'skills': other_user.get('skills', []),
-                'interests': other_user.get('interests', []),
-                'tech_stack': other_user.get('tech_stack', []),
-                'bio': other_user.get('bio', ''),
-                'match_reason': 'Matched based on skill and interest overlap',
-                'profile_photo': other_user.get('profile_photo', None)
-            })
-        
-        # Sort by score descending
-        matches.sort(key=lambda x: x['score'], reverse=True)
+        scores = self.score_candidates(user_profile, all_users, features)
         
-        return matches[:top_n]
+        return [
+            self._build_match(all_users[idx], float(scores[idx]),
+                              'Matched based on skill, interest and bio overlap')
+            for idx in top_k_indices(scores, top_n)
+        ]
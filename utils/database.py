@@ -1,268 +1,736 @@
 import sqlite3
-import json
+import queue
+import threading
+import time
+import orjson
+from collections import OrderedDict
+import numpy as np
+from scipy.sparse import csr_matrix
+from contextlib import contextmanager
 from datetime import datetime
 
+# Connections kept open per Database; callers block when all are checked out
+POOL_SIZE = 8
+
+# Connection returns between PRAGMA optimize runs, which refresh stale planner statistics
+OPTIMIZE_EVERY = 1000
+
+# Seconds a decoded profile (or the full user list) is served from memory
+PROFILE_CACHE_TTL = 60
+
+# Decoded profiles kept in memory; the least recently used are evicted past this
+PROFILE_CACHE_SIZE = 1024
+
+# Matching feature -> (profiles column, type) holding its precomputed value
+FEATURE_COLUMNS = {
+    'skills_bm': ('skill_ids', 'BLOB'),
+    'interests_bm': ('interest_ids', 'BLOB'),
+    'tech_bm': ('tech_ids', 'BLOB'),
+    'bio_emb': ('bio_embedding', 'BLOB'),  # int8 quantized
+    'bio_scale': ('bio_scale', 'REAL')
+}
+
+# Applied to every pooled connection
+CONNECTION_PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA foreign_keys=ON',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-20000',
+    'PRAGMA mmap_size=268435456'
+]
+
+# JSON columns (skills, interests, tech_stack, project_types, repl_data) hold raw orjson bytes;
+# rows written as TEXT by older versions decode the same way
+_dumps = orjson.dumps
+
+_loads = orjson.loads
+
+# Fixed statements, shared so each pooled connection's statement cache keeps them compiled
+_SQL_CREATE_USER = 'INSERT INTO users (username, email, password) VALUES (?, ?, ?)'
+
+_SQL_GET_USER = 'SELECT * FROM users WHERE username = ?'
+
+_SQL_UPSERT_PROFILE = '''
+    INSERT INTO profiles (user_id, skills, interests, tech_stack,
+    project_types, replit_username, bio, profile_photo)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+    skills = excluded.skills, interests = excluded.interests, tech_stack = excluded.tech_stack,
+    project_types = excluded.project_types, replit_username = excluded.replit_username,
+    bio = excluded.bio, profile_photo = COALESCE(excluded.profile_photo, profiles.profile_photo)
+'''
+
+_SQL_UPDATE_REPL_DATA = 'UPDATE profiles SET repl_data = ? WHERE user_id = ?'
+
+# Columns returned for a user with their profile; password and the matching features
+# (served by load_feature_matrix) stay in the database
+_USER_COLS = 'u.id AS user_id, u.username, u.email, u.created_at'
+
+_PROFILE_COLS = 'p.skills, p.interests, p.tech_stack, p.project_types, p.replit_username, p.bio, p.repl_data, p.profile_photo'
+
+_SQL_GET_ALL_USERS = f'''
+    SELECT {_USER_COLS}, {_PROFILE_COLS}
+    FROM users u
+    LEFT JOIN profiles p ON u.id = p.user_id
+'''
+
+_SQL_GET_USER_PROFILE = _SQL_GET_ALL_USERS + ' WHERE u.id = ?'
+
+_SQL_LOAD_FEATURES = 'SELECT user_id, skill_ids, interest_ids, tech_ids, bio_embedding, bio_scale FROM profiles'
+
+_SQL_PROFILE_SKILL_PAIRS = 'SELECT user_id, skill_id FROM profile_skills ORDER BY user_id'
+
+_SQL_DELETE_PROFILE_SKILLS = 'DELETE FROM profile_skills WHERE user_id = ?'
+
+_SQL_INSERT_PROFILE_SKILL = 'INSERT INTO profile_skills (user_id, skill_id) VALUES (?, ?)'
+
+_SQL_DELETE_PROFILE_INTERESTS = 'DELETE FROM profile_interests WHERE user_id = ?'
+
+_SQL_INSERT_PROFILE_INTEREST = 'INSERT INTO profile_interests (user_id, interest_id) VALUES (?, ?)'
+
+_SQL_DELETE_MATCHES = 'DELETE FROM matches WHERE user_id = ?'
+
+_SQL_INSERT_MATCH = 'INSERT INTO matches (user_id, matched_user_id, match_score) VALUES (?, ?, ?)'
+
+_SQL_GET_USER_MATCHES = f'''
+    SELECT m.matched_user_id, m.match_score, m.created_at, u.username, {_PROFILE_COLS}
+    FROM matches m
+    JOIN users u ON m.matched_user_id = u.id
+    LEFT JOIN profiles p ON u.id = p.user_id
+    WHERE m.user_id = ?
+    ORDER BY m.match_score DESC
+    LIMIT ?
+'''
+
+_SQL_CREATE_COLLABORATION = 'INSERT INTO collaborations (user1_id, user2_id, repl_url) VALUES (?, ?, ?)'
+
+_SQL_GET_COLLABORATION = 'SELECT * FROM collaborations WHERE id = ?'
+
+_SQL_GET_REPL_CACHE = 'SELECT fetched_at, data, etag FROM repl_cache WHERE username = ?'
+
+_SQL_SAVE_REPL_CACHE = '''
+    INSERT INTO repl_cache (username, fetched_at, data, etag) VALUES (?, ?, ?, ?)
+    ON CONFLICT(username) DO UPDATE SET
+    fetched_at = excluded.fetched_at, data = excluded.data, etag = excluded.etag
+'''
+
+class _ConnectionPool:
+    """Long-lived SQLite connections, opened on first demand and reused across requests"""
+    
+    def __init__(self, db_name, size=POOL_SIZE):
+        self.db_name = db_name
+        self.size = size
+        self._idle = queue.Queue(maxsize=size)
+        self._opened = 0
+        self._returns = 0
+        self._lock = threading.Lock()
+    
+    def _connect(self):
+        # Autocommit: each statement commits on its own unless a caller issues BEGIN.
+        # Pooled connections move between Flask worker threads.
+        conn = sqlite3.connect(self.db_name, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+    
+    def get(self):
+        """Take an idle connection, opening a new one while under the size limit"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_open = self._opened < self.size
+            if can_open:
+                self._opened += 1
+        if not can_open:
+            return self._idle.get()
+        try:
+            return self._connect()
+        except sqlite3.Error:
+            with self._lock:
+                self._opened -= 1
+            raise
+    
+    def put(self, conn):
+        """Return a connection, discarding any transaction left open on it"""
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self._returns += 1
+            optimize = self._returns % OPTIMIZE_EVERY == 0
+        if optimize:
+            # Cheap unless the statistics are out of date
+            conn.execute('PRAGMA optimize')
+        self._idle.put(conn)
+
 class Database:
     def __init__(self, db_name='replimatch.db'):
         self.db_name = db_name
+        # Feature matrices for matching and search, rebuilt lazily after profile writes
+        self._feature_matrix = None
+        # Bumped after every feature write so a rebuild that raced one isn't cached; the lock
+        # makes a writer's bump-and-clear and a rebuild's check-and-store atomic
+        self._feature_generation = 0
+        self._feature_lock = threading.Lock()
+        # Sparse user x skill matrix from profile_skills, rebuilt lazily after profile writes
+        self._profile_snapshot = None
+        self._snapshot_generation = 0
+        self._snapshot_lock = threading.Lock()
+        # Decoded profiles in LRU order: user_id -> (expires, profile), plus (expires, users)
+        # for get_all_users. The generation counter stops a read that raced a write from caching stale rows.
+        self._profile_cache = OrderedDict()
+        self._profile_cache_lock = threading.Lock()
+        self._all_users_cache = None
+        self._profile_generation = 0
+        self._pool = _ConnectionPool(db_name)
         self.init_db()
     
-    def get_connection(self):
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        return conn
+    @contextmanager
+    def _conn(self):
+        """Check a connection out of the pool for the duration of the block"""
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+    
+    @contextmanager
+    def _transaction(self):
+        """Run the block as a single write transaction, taking the write lock up front"""
+        with self._conn() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            yield conn
+            # On error the pool rolls back the open transaction
+            conn.execute('COMMIT')
+    
+    def invalidate_profile(self, user_id):
+        """Drop cached reads that include the given user's profile"""
+        with self._profile_cache_lock:
+            self._profile_generation += 1
+            self._profile_cache.pop(user_id, None)
+        self._all_users_cache = None
     
     def init_db(self):
         """Initialize database tables"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self._conn() as conn:
+            cursor = conn.cursor()
+            
+            # Users table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT UNIQUE NOT NULL,
+                    email TEXT UNIQUE NOT NULL,
+                    password TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Profiles table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS profiles (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER UNIQUE,
+                    skills BLOB,
+                    interests BLOB,
+                    tech_stack BLOB,
+                    project_types BLOB,
+                    replit_username TEXT,
+                    bio TEXT,
+                    repl_data BLOB,
+                    profile_photo TEXT,
+                    skill_ids BLOB,
+                    interest_ids BLOB,
+                    tech_ids BLOB,
+                    bio_embedding BLOB,
+                    bio_scale REAL,
+                    FOREIGN KEY (user_id) REFERENCES users (id)
+                )
+            ''')
+            
+            # Skill dictionary; ids are bit positions in profiles.skill_ids and tech_ids
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS skills (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT UNIQUE NOT NULL
+                )
+            ''')
+            
+            # Interest dictionary; ids are bit positions in profiles.interest_ids
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS interests (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT UNIQUE NOT NULL
+                )
+            ''')
+            
+            # Normalized copies of each profile's interned skills and interests, so overlap
+            # can be computed in SQL with an indexed join; the JSON columns keep display order
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS profile_skills (
+                    user_id INTEGER NOT NULL,
+                    skill_id INTEGER NOT NULL,
+                    PRIMARY KEY (user_id, skill_id),
+                    FOREIGN KEY (user_id) REFERENCES users (id),
+                    FOREIGN KEY (skill_id) REFERENCES skills (id)
+                ) WITHOUT ROWID
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS profile_interests (
+                    user_id INTEGER NOT NULL,
+                    interest_id INTEGER NOT NULL,
+                    PRIMARY KEY (user_id, interest_id),
+                    FOREIGN KEY (user_id) REFERENCES users (id),
+                    FOREIGN KEY (interest_id) REFERENCES interests (id)
+                ) WITHOUT ROWID
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_profile_skills_skill ON profile_skills (skill_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_profile_interests_interest ON profile_interests (interest_id)')
+            
+            # Matches table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS matches (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    matched_user_id INTEGER,
+                    match_score REAL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users (id),
+                    FOREIGN KEY (matched_user_id) REFERENCES users (id)
+                )
+            ''')
+            
+            # Last successful Repl analysis per Replit username, reused across restarts
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS repl_cache (
+                    username TEXT PRIMARY KEY,
+                    fetched_at REAL NOT NULL,
+                    data BLOB NOT NULL,
+                    etag TEXT
+                )
+            ''')
+            
+            # Collaborations table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS collaborations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user1_id INTEGER,
+                    user2_id INTEGER,
+                    repl_url TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user1_id) REFERENCES users (id),
+                    FOREIGN KEY (user2_id) REFERENCES users (id)
+                )
+            ''')
+            
+            # users.username and profiles.user_id are UNIQUE, so SQLite already indexes them.
+            # This one serves get_user_matches' filter and ORDER BY without a temp sort.
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_matches_user_score
+                ON matches (user_id, match_score DESC)
+            ''')
+            
+            # Columns added after the original schema; older databases need them appended
+            columns = [row['name'] for row in cursor.execute('PRAGMA table_info(profiles)')]
+            for column, column_type in FEATURE_COLUMNS.values():
+                if column not in columns:
+                    cursor.execute(f'ALTER TABLE profiles ADD COLUMN {column} {column_type}')
+            if 'etag' not in [row['name'] for row in cursor.execute('PRAGMA table_info(repl_cache)')]:
+                cursor.execute('ALTER TABLE repl_cache ADD COLUMN etag TEXT')
+            
+            # Gather planner statistics once so the indexes above get used; PRAGMA optimize
+            # on connection return keeps them current afterwards
+            if not cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone():
+                cursor.execute('ANALYZE')
         
-        # Users table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                email TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        self.backfill_feature_vectors()
+    
+    def backfill_feature_vectors(self):
+        """Compute bitsets and profile term rows for profiles saved without them"""
+        with self._conn() as conn:
+            rows = conn.execute('''
+                SELECT user_id, skills, interests, tech_stack FROM profiles
+                WHERE skill_ids IS NULL OR interest_ids IS NULL OR tech_ids IS NULL
+            ''').fetchall()
         
-        # Profiles table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS profiles (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER UNIQUE,
-                skills TEXT,
-                interests TEXT,
-                tech_stack TEXT,
-                project_types TEXT,
-                replit_username TEXT,
-                bio TEXT,
-                repl_data TEXT,
-                profile_photo TEXT,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
+        for row in rows:
+            profile_data = {
+                field: _loads(row[field]) if row[field] else []
+                for field in ['skills', 'interests', 'tech_stack']
+            }
+            with self._transaction() as conn:
+                self._write_feature_vectors(conn, row['user_id'], self.encode_profile(conn, profile_data))
+            self._invalidate_features(row['user_id'])
         
-        # Matches table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS matches (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                matched_user_id INTEGER,
-                match_score REAL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                FOREIGN KEY (matched_user_id) REFERENCES users (id)
-            )
-        ''')
+        with self._conn() as conn:
+            rows = conn.execute('''
+                SELECT user_id, skill_ids, interest_ids FROM profiles p
+                WHERE user_id IS NOT NULL
+                AND NOT EXISTS (SELECT 1 FROM profile_skills s WHERE s.user_id = p.user_id)
+                AND NOT EXISTS (SELECT 1 FROM profile_interests i WHERE i.user_id = p.user_id)
+            ''').fetchall()
         
-        # Collaborations table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS collaborations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user1_id INTEGER,
-                user2_id INTEGER,
-                repl_url TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user1_id) REFERENCES users (id),
-                FOREIGN KEY (user2_id) REFERENCES users (id)
+        for row in rows:
+            self.save_profile_terms(row['user_id'], {
+                'skills_bm': row['skill_ids'],
+                'interests_bm': row['interest_ids']
+            })
+    
+    @staticmethod
+    def canonical_skill(name):
+        """Normalize a skill or interest name for interning and lookup"""
+        return name.strip().lower()
+    
+    @staticmethod
+    def to_bitset(ids):
+        """Pack integer ids into a little-endian bitset"""
+        bits = 0
+        for skill_id in ids:
+            bits |= 1 << skill_id
+        return bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+    
+    @staticmethod
+    def from_bitset(bits):
+        """Unpack a little-endian bitset into its sorted integer ids"""
+        bits = np.frombuffer(bits or b'', dtype=np.uint8)
+        return np.flatnonzero(np.unpackbits(bits, bitorder='little')).tolist()
+    
+    @staticmethod
+    def quantize_embedding(embedding):
+        """Quantize an embedding to int8 with a per-vector scale (value = int8 / scale)"""
+        embedding = np.asarray(embedding, dtype=np.float32)
+        peak = float(np.max(np.abs(embedding), initial=0.0))
+        scale = 127.0 / peak if peak > 0 else 1.0
+        return np.round(embedding * scale).astype(np.int8), scale
+    
+    @classmethod
+    def _bitsets_to_csr(cls, bitsets):
+        """Sparse float32 0/1 matrix whose row i has column j set for each id j in bitsets[i]"""
+        ids = [cls.from_bitset(bits) for bits in bitsets]
+        indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum([len(row) for row in ids], out=indptr[1:])
+        indices = np.array([term_id for row in ids for term_id in row], dtype=np.int64)
+        width = int(indices.max()) + 1 if len(indices) else 0
+        return csr_matrix(
+            (np.ones(len(indices), dtype=np.float32), indices, indptr),
+            shape=(len(ids), width)
+        )
+    
+    def _intern_terms(self, conn, table, names):
+        """Intern names in a dictionary table in one batch, returning their integer ids"""
+        names = list({self.canonical_skill(name) for name in names} - {''})
+        if not names:
+            return []
+        conn.executemany(f'INSERT OR IGNORE INTO {table} (name) VALUES (?)', [(name,) for name in names])
+        rows = conn.execute(
+            f'SELECT id FROM {table} WHERE name IN ({", ".join("?" * len(names))})',
+            names
+        )
+        return [row['id'] for row in rows]
+    
+    def find_skill_ids(self, names):
+        """Map already-interned skill names to their ids, skipping unknown ones"""
+        names = list({self.canonical_skill(name) for name in names})
+        if not names:
+            return {}
+        with self._conn() as conn:
+            rows = conn.execute(
+                f'SELECT id, name FROM skills WHERE name IN ({", ".join("?" * len(names))})',
+                names
             )
-        ''')
+            skill_ids = {row['name']: row['id'] for row in rows}
+        return skill_ids
+    
+    def encode_profile(self, conn, profile_data):
+        """Intern a profile's terms on conn and return its skills, interests and tech stack bitsets"""
+        skills_bm = self.to_bitset(self._intern_terms(conn, 'skills', profile_data['skills']))
+        # The profile form sends the same list for both; skip re-interning it
+        if profile_data['tech_stack'] == profile_data['skills']:
+            tech_bm = skills_bm
+        else:
+            tech_bm = self.to_bitset(self._intern_terms(conn, 'skills', profile_data['tech_stack']))
+        return {
+            'skills_bm': skills_bm,
+            'interests_bm': self.to_bitset(self._intern_terms(conn, 'interests', profile_data['interests'])),
+            'tech_bm': tech_bm
+        }
+    
+    @staticmethod
+    def _write_feature_vectors(conn, user_id, features):
+        """UPDATE the given precomputed matching features on conn"""
+        columns = [FEATURE_COLUMNS[key][0] for key in features]
+        conn.execute(
+            f'UPDATE profiles SET {", ".join(f"{column} = ?" for column in columns)} WHERE user_id = ?',
+            (*features.values(), user_id)
+        )
+    
+    def _write_profile_terms(self, conn, user_id, features):
+        """Replace a profile's profile_skills and profile_interests rows on conn from its bitsets"""
+        conn.execute(_SQL_DELETE_PROFILE_SKILLS, (user_id,))
+        conn.executemany(
+            _SQL_INSERT_PROFILE_SKILL,
+            [(user_id, skill_id) for skill_id in self.from_bitset(features['skills_bm'])]
+        )
+        conn.execute(_SQL_DELETE_PROFILE_INTERESTS, (user_id,))
+        conn.executemany(
+            _SQL_INSERT_PROFILE_INTEREST,
+            [(user_id, interest_id) for interest_id in self.from_bitset(features['interests_bm'])]
+        )
+    
+    def _invalidate_features(self, user_id):
+        """Drop the feature matrix and cached profile after a feature write"""
+        with self._feature_lock:
+            self._feature_generation += 1
+            self._feature_matrix = None
+        self.invalidate_profile(user_id)
+    
+    def _invalidate_snapshot(self):
+        """Drop the profile_skills snapshot after a term write"""
+        with self._snapshot_lock:
+            self._snapshot_generation += 1
+            self._profile_snapshot = None
+    
+    def save_feature_vectors(self, user_id, features):
+        """Persist precomputed matching features; only the given keys are written"""
+        with self._conn() as conn:
+            self._write_feature_vectors(conn, user_id, features)
+        self._invalidate_features(user_id)
+    
+    def save_profile_terms(self, user_id, features):
+        """Replace a profile's rows in profile_skills and profile_interests from its bitsets"""
+        with self._transaction() as conn:
+            self._write_profile_terms(conn, user_id, features)
+        self._invalidate_snapshot()
+    
+    def load_feature_matrix(self):
+        """Return every profile's matching features as contiguous arrays, cached until the next write
         
-        conn.commit()
-        conn.close()
+        Keys: user_ids, row_index (user_id -> row), skills, interests, tech_stack
+        (sparse float32 0/1 CSR matrices, one column per interned id),
+        bio_embedding (int8, zero rows for profiles without a quantized embedding,
+        or None when no profile has one) and has_embedding (bool mask of its real rows).
+        """
+        features = self._feature_matrix
+        if features is None:
+            generation = self._feature_generation
+            with self._conn() as conn:
+                rows = conn.execute(_SQL_LOAD_FEATURES).fetchall()
+            
+            user_ids = np.array([row['user_id'] for row in rows], dtype=np.int64)
+            embeddings = [row['bio_embedding'] if row['bio_scale'] is not None else None for row in rows]
+            lengths = np.array([len(e) if e else 0 for e in embeddings], dtype=np.int64)
+            bio_embedding = has_embedding = None
+            if lengths.any():
+                # Rows of any other size (an older embedding model) count as missing
+                sizes, counts = np.unique(lengths[lengths > 0], return_counts=True)
+                width = int(sizes[counts.argmax()])
+                has_embedding = lengths == width
+                bio_embedding = np.zeros((len(rows), width), dtype=np.int8)
+                bio_embedding[has_embedding] = np.frombuffer(
+                    b''.join(e for e, present in zip(embeddings, has_embedding) if present), dtype=np.int8
+                ).reshape(-1, width)
+            
+            features = {
+                'user_ids': user_ids,
+                'row_index': {user_id: i for i, user_id in enumerate(user_ids.tolist())},
+                'skills': self._bitsets_to_csr([row['skill_ids'] for row in rows]),
+                'interests': self._bitsets_to_csr([row['interest_ids'] for row in rows]),
+                'tech_stack': self._bitsets_to_csr([row['tech_ids'] for row in rows]),
+                'bio_embedding': bio_embedding,
+                'has_embedding': has_embedding
+            }
+            with self._feature_lock:
+                if generation == self._feature_generation:
+                    self._feature_matrix = features
+        return features
+    
+    def snapshot_profiles(self):
+        """Return (user_ids, matrix): a sparse boolean row of skill ids per user with skills, cached until the next write
+        
+        matrix @ query counts each user's skills in a 0/1 query vector, and
+        matrix @ matrix.T gives every pairwise skill overlap in one product.
+        """
+        snapshot = self._profile_snapshot
+        if snapshot is None:
+            generation = self._snapshot_generation
+            with self._conn() as conn:
+                pairs = np.array(conn.execute(_SQL_PROFILE_SKILL_PAIRS).fetchall(), dtype=np.int64).reshape(-1, 2)
+            
+            user_ids, rows = np.unique(pairs[:, 0], return_inverse=True)
+            width = int(pairs[:, 1].max()) + 1 if len(pairs) else 0
+            matrix = csr_matrix(
+                (np.ones(len(pairs), dtype=bool), (rows, pairs[:, 1])),
+                shape=(len(user_ids), width)
+            )
+            snapshot = (user_ids, matrix)
+            # A rebuild that raced a term write may predate it; don't keep it
+            with self._snapshot_lock:
+                if generation == self._snapshot_generation:
+                    self._profile_snapshot = snapshot
+        return snapshot
     
     def create_user(self, username, email, password):
         """Create a new user"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO users (username, email, password) VALUES (?, ?, ?)',
-            (username, email, password)
-        )
-        user_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        with self._conn() as conn:
+            user_id = conn.execute(_SQL_CREATE_USER, (username, email, password)).lastrowid
+        self.invalidate_profile(user_id)
         return user_id
     
     def get_user(self, username):
         """Get user by username"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
-        user = cursor.fetchone()
-        conn.close()
+        with self._conn() as conn:
+            user = conn.execute(_SQL_GET_USER, (username,)).fetchone()
         return dict(user) if user else None
     
     def update_profile(self, user_id, profile_data):
-        """Update or create user profile"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT id FROM profiles WHERE user_id = ?', (user_id,))
-        existing = cursor.fetchone()
-        
-        if existing:
-            cursor.execute('''
-                UPDATE profiles SET
-                skills = ?, interests = ?, tech_stack = ?,
-                project_types = ?, replit_username = ?, bio = ?, profile_photo = ?
-                WHERE user_id = ?
-            ''', (
-                json.dumps(profile_data['skills']),
-                json.dumps(profile_data['interests']),
-                json.dumps(profile_data['tech_stack']),
-                json.dumps(profile_data['project_types']),
-                profile_data['replit_username'],
-                profile_data['bio'],
-                profile_data.get('profile_photo'),
-                user_id
-            ))
-        else:
-            cursor.execute('''
-                INSERT INTO profiles (user_id, skills, interests, tech_stack,
-                project_types, replit_username, bio, profile_photo)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
+        """Update or create user profile; a profile_photo of None keeps the stored photo"""
+        # One transaction, so the JSON columns, bitsets and term rows can't disagree after a failure
+        with self._transaction() as conn:
+            conn.execute(_SQL_UPSERT_PROFILE, (
                 user_id,
-                json.dumps(profile_data['skills']),
-                json.dumps(profile_data['interests']),
-                json.dumps(profile_data['tech_stack']),
-                json.dumps(profile_data['project_types']),
+                _dumps(profile_data['skills']),
+                _dumps(profile_data['interests']),
+                _dumps(profile_data['tech_stack']),
+                _dumps(profile_data['project_types']),
                 profile_data['replit_username'],
                 profile_data['bio'],
                 profile_data.get('profile_photo')
             ))
+            features = self.encode_profile(conn, profile_data)
+            self._write_feature_vectors(conn, user_id, features)
+            self._write_profile_terms(conn, user_id, features)
         
-        conn.commit()
-        conn.close()
+        self._invalidate_features(user_id)
+        self._invalidate_snapshot()
     
     def update_repl_data(self, user_id, repl_data):
         """Update user's Repl analysis data"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'UPDATE profiles SET repl_data = ? WHERE user_id = ?',
-            (json.dumps(repl_data), user_id)
-        )
-        conn.commit()
-        conn.close()
+        with self._conn() as conn:
+            conn.execute(_SQL_UPDATE_REPL_DATA, (_dumps(repl_data), user_id))
+        self.invalidate_profile(user_id)
+    
+    @staticmethod
+    def _decode_profile(row):
+        """Turn a user/profile row into a dict with its JSON fields parsed"""
+        data = dict(row)
+        for field in ['skills', 'interests', 'tech_stack', 'project_types', 'repl_data']:
+            if data.get(field):
+                data[field] = _loads(data[field])
+        return data
     
     def get_user_profile(self, user_id):
         """Get complete user profile"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT u.*, p.*
-            FROM users u
-            LEFT JOIN profiles p ON u.id = p.user_id
-            WHERE u.id = ?
-        ''', (user_id,))
-        profile = cursor.fetchone()
-        conn.close()
+        with self._profile_cache_lock:
+            cached = self._profile_cache.get(user_id)
+            if cached and cached[0] > time.monotonic():
+                self._profile_cache.move_to_end(user_id)
+                return dict(cached[1])
+            if cached:
+                del self._profile_cache[user_id]
+            generation = self._profile_generation
+        
+        with self._conn() as conn:
+            profile = conn.execute(_SQL_GET_USER_PROFILE, (user_id,)).fetchone()
         
         if profile:
-            data = dict(profile)
-            # Parse JSON fields
-            for field in ['skills', 'interests', 'tech_stack', 'project_types', 'repl_data']:
-                if data.get(field):
-                    data[field] = json.loads(data[field])
-            return data
+            data = self._decode_profile(profile)
+            with self._profile_cache_lock:
+                if generation == self._profile_generation:
+                    self._profile_cache[user_id] = (time.monotonic() + PROFILE_CACHE_TTL, data)
+                    self._profile_cache.move_to_end(user_id)
+                    while len(self._profile_cache) > PROFILE_CACHE_SIZE:
+                        self._profile_cache.popitem(last=False)
+            return dict(data)
         return None
     
+    def iter_all_users(self, exclude_id=None):
+        """Yield all users except specified ID, decoding rows as they are read unless the list is cached"""
+        cached = self._all_users_cache
+        if cached and cached[0] > time.monotonic():
+            for user in cached[1]:
+                if not exclude_id or user['user_id'] != exclude_id:
+                    yield dict(user)
+            return
+        
+        # The pooled connection stays checked out until the generator is exhausted or closed
+        with self._conn() as conn:
+            for row in conn.execute(_SQL_GET_ALL_USERS):
+                if not exclude_id or row['user_id'] != exclude_id:
+                    yield self._decode_profile(row)
+    
     def get_all_users(self, exclude_id=None):
         """Get all users except specified ID"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        if exclude_id:
-            cursor.execute('''
-                SELECT u.*, p.*
-                FROM users u
-                LEFT JOIN profiles p ON u.id = p.user_id
-                WHERE u.id != ?
-            ''', (exclude_id,))
-        else:
-            cursor.execute('''
-                SELECT u.*, p.*
-                FROM users u
-                LEFT JOIN profiles p ON u.id = p.user_id
-            ''')
+        cached = self._all_users_cache
+        if not cached or cached[0] <= time.monotonic():
+            generation = self._profile_generation
+            cached = (time.monotonic() + PROFILE_CACHE_TTL, list(self.iter_all_users()))
+            if generation == self._profile_generation:
+                self._all_users_cache = cached
         
-        users = cursor.fetchall()
-        conn.close()
+        return [dict(user) for user in cached[1] if not exclude_id or user['user_id'] != exclude_id]
+    
+    def get_users_by_ids(self, user_ids):
+        """Get complete profiles for the given users, in the given order"""
+        user_ids = [int(user_id) for user_id in user_ids]
+        if not user_ids:
+            return []
+        with self._conn() as conn:
+            users = conn.execute(
+                f'{_SQL_GET_ALL_USERS} WHERE u.id IN ({", ".join("?" * len(user_ids))})',
+                user_ids
+            ).fetchall()
         
-        result = []
+        by_id = {}
         for user in users:
-            data = dict(user)
-            for field in ['skills', 'interests', 'tech_stack', 'project_types', 'repl_data']:
-                if data.get(field):
-                    data[field] = json.loads(data[field])
-            result.append(data)
-        return result
+            data = self._decode_profile(user)
+            by_id[data['user_id']] = data
+        return [by_id[user_id] for user_id in user_ids if user_id in by_id]
     
     def save_matches(self, user_id, matches):
         """Save user matches"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Clear old matches
-        cursor.execute('DELETE FROM matches WHERE user_id = ?', (user_id,))
-        
-        # Insert new matches
-        for match in matches:
-            cursor.execute('''
-                INSERT INTO matches (user_id, matched_user_id, match_score)
-                VALUES (?, ?, ?)
-            ''', (user_id, match['user_id'], match['score']))
-        
-        conn.commit()
-        conn.close()
-    
-    def get_user_matches(self, user_id):
-        """Get user's matches"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT m.*, u.username, p.*
-            FROM matches m
-            JOIN users u ON m.matched_user_id = u.id
-            LEFT JOIN profiles p ON u.id = p.user_id
-            WHERE m.user_id = ?
-            ORDER BY m.match_score DESC
-        ''', (user_id,))
-        
-        matches = cursor.fetchall()
-        conn.close()
-        
-        result = []
-        for match in matches:
-            data = dict(match)
-            for field in ['skills', 'interests', 'tech_stack', 'project_types']:
-                if data.get(field):
-                    data[field] = json.loads(data[field])
-            result.append(data)
-        return result
+        with self._transaction() as conn:
+            # Clear old matches
+            conn.execute(_SQL_DELETE_MATCHES, (user_id,))
+            
+            # Insert new matches
+            conn.executemany(
+                _SQL_INSERT_MATCH,
+                [(user_id, match['user_id'], float(match['score'])) for match in matches]
+            )
+    
+    def get_user_matches(self, user_id, limit=20):
+        """Get user's top matches, best first"""
+        with self._conn() as conn:
+            matches = conn.execute(_SQL_GET_USER_MATCHES, (user_id, limit)).fetchall()
+        return [self._decode_profile(match) for match in matches]
     
     def create_collaboration(self, collab_data):
         """Create a new collaboration"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO collaborations (user1_id, user2_id, repl_url)
-            VALUES (?, ?, ?)
-        ''', (collab_data['user1_id'], collab_data['user2_id'], collab_data['repl_url']))
-        collab_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        with self._conn() as conn:
+            collab_id = conn.execute(
+                _SQL_CREATE_COLLABORATION,
+                (collab_data['user1_id'], collab_data['user2_id'], collab_data['repl_url'])
+            ).lastrowid
         return collab_id
     
     def get_collaboration(self, collab_id):
         """Get collaboration details"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM collaborations WHERE id = ?', (collab_id,))
-        collab = cursor.fetchone()
-        conn.close()
+        with self._conn() as conn:
+            collab = conn.execute(_SQL_GET_COLLABORATION, (collab_id,)).fetchone()
         return dict(collab) if collab else None
+    
+    def get_repl_cache(self, username):
+        """Get the stored Repl analysis for a Replit username as {'fetched_at', 'analysis', 'etag'}"""
+        with self._conn() as conn:
+            row = conn.execute(_SQL_GET_REPL_CACHE, (username,)).fetchone()
+        if not row:
+            return None
+        return {'fetched_at': row['fetched_at'], 'analysis': _loads(row['data']), 'etag': row['etag']}
+    
+    def save_repl_cache(self, username, analysis, fetched_at, etag=None):
+        """Store the latest Repl analysis for a Replit username, with the ETag it was served under"""
+        with self._conn() as conn:
+            conn.execute(_SQL_SAVE_REPL_CACHE, (username, fetched_at, _dumps(analysis), etag))
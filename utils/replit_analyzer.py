@@ -1,63 +1,200 @@
+import copy
+import time
+import threading
+import asyncio
+import httpx
+import orjson
 import requests
-from collections import Counter
+from collections import Counter, OrderedDict
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+# Seconds a fetched analysis is reused before Replit is asked again
+REPL_CACHE_TTL = 600
+
+# Analyses kept in memory; the least recently used fall back to the store past this
+REPL_CACHE_SIZE = 1024
+
+# Seconds to wait on Replit before falling back to the default analysis
+REQUEST_TIMEOUT = 5
+
+# Concurrent Replit requests made by analyze_many
+ANALYZE_CONCURRENCY = 16
+
+# Keep-alive connections held open to replit.com for the background analysis workers
+HTTP_POOL_SIZE = 64
+
+# Returned (as a shallow copy) when a user's Repls can't be fetched; its lists are
+# shared with every copy and with analyses that found no data, so treat them as read-only
+_DEFAULT_ANALYSIS = {
+    'languages': ['Python'],  # Default to Python
+    'project_types': ['web'],  # Default to web development
+    'coding_patterns': [],
+    'activity_level': 'new',  # Mark as new user
+    'language_counts': {},
+    'project_type_counts': {}
+}
+
+class _TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that applies REQUEST_TIMEOUT to requests made without one"""
+    
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = REQUEST_TIMEOUT
+        return super().send(request, **kwargs)
 
 class ReplAnalyzer:
-    def __init__(self):
+    def __init__(self, store=None):
         self.replit_api_base = "https://replit.com/api/v1/repls"
+        # Optional persistent cache (the Database) behind the in-process one
+        self.store = store
+        self._cache = OrderedDict()  # username -> (fetched_at, analysis, etag), in LRU order
+        self._cache_lock = threading.Lock()
         self.session = requests.Session()
         self.session.headers.update({
             'User-Agent': 'ReplMatch/1.0',
             'Accept': 'application/json'
         })
+        # Retry transient failures briefly; the last response is still returned so
+        # raise_for_status and the default-analysis fallback behave as before
+        retries = Retry(
+            total=2,
+            backoff_factor=0.2,
+            status_forcelist=(429, 502, 503, 504),
+            raise_on_status=False
+        )
+        self.session.mount('https://', _TimeoutHTTPAdapter(pool_maxsize=HTTP_POOL_SIZE, max_retries=retries))
+    
+    def _cache_entry(self, key):
+        """Return the cached (fetched_at, analysis, etag) for a username, checking memory then the store"""
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+                return entry
+        if self.store is not None:
+            stored = self.store.get_repl_cache(key)
+            if stored:
+                entry = (stored['fetched_at'], stored['analysis'], stored['etag'])
+                self._remember(key, entry)
+        return entry
+    
+    def _remember(self, key, entry):
+        """Store an entry in the in-memory cache, evicting the least recently used past REPL_CACHE_SIZE"""
+        with self._cache_lock:
+            self._cache[key] = entry
+            self._cache.move_to_end(key)
+            while len(self._cache) > REPL_CACHE_SIZE:
+                self._cache.popitem(last=False)
+    
+    def _cache_analysis(self, key, analysis, etag=None):
+        """Remember a fetched (or revalidated) analysis in memory and in the store"""
+        fetched_at = time.time()
+        self._remember(key, (fetched_at, analysis, etag))
+        if self.store is not None:
+            self.store.save_repl_cache(key, analysis, fetched_at, etag)
+    
+    @staticmethod
+    def _revalidation_headers(entry):
+        """Conditional headers for a stale cache entry: an unchanged Repl list comes back as a bodiless 304"""
+        return {'If-None-Match': entry[2]} if entry and entry[2] else {}
+    
+    def _analysis_from_response(self, key, entry, response):
+        """Build and cache the analysis from a requests or httpx response"""
+        if response.status_code == 304 and entry:
+            self._cache_analysis(key, entry[1], entry[2])
+            return dict(entry[1])
+        
+        response.raise_for_status()
+        repls_data = orjson.loads(response.content)
+        
+        repls = [repl for repl in repls_data if isinstance(repl, dict)] if isinstance(repls_data, list) else []
+        languages = Counter(repl['language'] for repl in repls if 'language' in repl)
+        project_types = Counter(repl['project_type'] for repl in repls if 'project_type' in repl)
+        
+        analysis = {
+            'languages': list(languages) if languages else _DEFAULT_ANALYSIS['languages'],
+            'project_types': list(project_types) if project_types else _DEFAULT_ANALYSIS['project_types'],
+            'coding_patterns': _DEFAULT_ANALYSIS['coding_patterns'],
+            'activity_level': 'active' if languages else 'new',  # Mark as new user if no repls found
+            # How many Repls use each language / project type, for weighting matches
+            'language_counts': dict(languages),
+            'project_type_counts': dict(project_types)
+        }
+        
+        self._cache_analysis(key, analysis, response.headers.get('ETag'))
+        return dict(analysis)
     
     def analyze_user_repls(self, username):
         """
         Analyze a user's public Repls to determine coding patterns
         Note: This is a simplified version. In production, use Replit's official API
         """
+        # Replit usernames are case-insensitive
+        key = username.lower()
+        entry = self._cache_entry(key)
+        if entry and time.time() - entry[0] < REPL_CACHE_TTL:
+            return dict(entry[1])
+        headers = self._revalidation_headers(entry)
+        
         try:
             # First try the v1 API
             url = f"{self.replit_api_base}/@{username}"
-            response = self.session.get(url)
+            response = self.session.get(url, headers=headers)
             
             # If v1 API fails, try the data API
             if response.status_code == 404:
                 url = f"https://replit.com/data/profiles/@{username}/repls"
-                response = self.session.get(url)
-            
-            response.raise_for_status()
-            repls_data = response.json()
-            
-            languages = []
-            project_types = []
-            coding_patterns = []
+                response = self.session.get(url, headers=headers)
             
-            if isinstance(repls_data, list):
-                for repl in repls_data:
-                    if isinstance(repl, dict):
-                        if 'language' in repl:
-                            languages.append(repl['language'])
-                        if 'project_type' in repl:
-                            project_types.append(repl['project_type'])
+            return self._analysis_from_response(key, entry, response)
             
-            analysis = {
-                'languages': list(set(languages)) if languages else ['Python'],  # Default to Python if no data
-                'project_types': list(set(project_types)) if project_types else ['web'],  # Default to web if no data
-                'coding_patterns': coding_patterns,
-                'activity_level': 'active' if languages else 'new'  # Mark as new user if no repls found
-            }
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Info: Could not fetch Replit data for user {username}: {str(e)}")
+            # Return default values instead of empty lists
+            return copy.copy(_DEFAULT_ANALYSIS)
+    
+    def _async_client(self, concurrency=ANALYZE_CONCURRENCY):
+        """httpx client with the sync session's headers, for the async analysis path"""
+        return httpx.AsyncClient(
+            headers=dict(self.session.headers),
+            timeout=REQUEST_TIMEOUT,
+            limits=httpx.Limits(max_connections=concurrency)
+        )
+    
+    async def analyze_user_repls_async(self, username, client=None):
+        """Async analyze_user_repls; pass an httpx.AsyncClient to share its connections"""
+        key = username.lower()
+        entry = self._cache_entry(key)
+        if entry and time.time() - entry[0] < REPL_CACHE_TTL:
+            return dict(entry[1])
+        
+        if client is None:
+            async with self._async_client() as client:
+                return await self.analyze_user_repls_async(username, client)
+        headers = self._revalidation_headers(entry)
+        
+        try:
+            response = await client.get(f"{self.replit_api_base}/@{username}", headers=headers)
+            if response.status_code == 404:
+                response = await client.get(f"https://replit.com/data/profiles/@{username}/repls", headers=headers)
             
-            return analysis
+            return self._analysis_from_response(key, entry, response)
             
-        except requests.exceptions.RequestException as e:
+        except (httpx.HTTPError, ValueError) as e:
             print(f"Info: Could not fetch Replit data for user {username}: {str(e)}")
-            # Return default values instead of empty lists
-            return {
-                'languages': ['Python'],  # Default to Python
-                'project_types': ['web'],  # Default to web development
-                'coding_patterns': [],
-                'activity_level': 'new'  # Mark as new user
-            }
+            return copy.copy(_DEFAULT_ANALYSIS)
+    
+    async def analyze_many(self, usernames, concurrency=ANALYZE_CONCURRENCY):
+        """Analyze several users' Repls concurrently, returning analyses in the given order"""
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async with self._async_client(concurrency) as client:
+            async def analyze(username):
+                async with semaphore:
+                    return await self.analyze_user_repls_async(username, client)
+            
+            return await asyncio.gather(*(analyze(username) for username in usernames))
     
     def analyze_repository(self, repo_url):
         """Analyze a GitHub or Replit repository"""